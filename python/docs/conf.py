@@ -48,12 +48,12 @@ import google.protobuf
 
 # -- Project information -----------------------------------------------------
 
-project = u"Protocol Buffers"
-copyright = u"2008, Google LLC"
-author = u"Google LLC"
+project = "Protocol Buffers"
+copyright = "2008, Google LLC"
+author = "Google LLC"
 
 # The short X.Y version
-version = u""
+version = ""
 # The full version, including alpha/beta/rc tags
 release = google.protobuf.__version__
 
@@ -96,7 +96,7 @@ language = None
 # List of patterns, relative to source directory, that match files and
 # directories to ignore when looking for source files.
 # This pattern also affects html_static_path and html_extra_path.
-exclude_patterns = [u"_build", "Thumbs.db", ".DS_Store"]
+exclude_patterns = ["_build", "Thumbs.db", ".DS_Store"]
 
 # The name of the Pygments (syntax highlighting) style to use.
 pygments_style = None
@@ -202,7 +202,7 @@ texinfo_documents = [
   (
     master_doc,
     "ProtocolBuffers",
-    u"Protocol Buffers Documentation",
+    "Protocol Buffers Documentation",
     author,
     "ProtocolBuffers",
     "One line description of project.",
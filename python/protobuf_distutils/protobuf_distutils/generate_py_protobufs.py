@@ -32,12 +32,46 @@
 
 __author__ = 'dlj@google.com (David L. Jones)'
 
-import glob
+import hashlib
+import json
+import re
 import sys
 import os
 import distutils.spawn as spawn
+from concurrent.futures import ThreadPoolExecutor
 from distutils.cmd import Command
 from distutils.errors import DistutilsOptionError, DistutilsExecError
+from functools import lru_cache
+
+# Below this many .proto files, the startup cost of extra protoc processes
+# outweighs any win from running them concurrently, so a single invocation
+# is used regardless of --jobs.
+_PARALLEL_THRESHOLD = 8
+
+# Matches the import statement forms accepted by protoc; group 1 is the
+# imported path, which protoc resolves relative to the --proto_path roots.
+_IMPORT_RE = re.compile(r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"')
+
+# Dependency cache, stored under output_dir. 'imports' maps each source
+# path (relative to proto_root_path) to [mtime, [imported paths]];
+# 'compiled' maps each source path to the source mtime at its last
+# successful compilation.
+_DEP_CACHE_NAME = '.proto_deps.json'
+
+# Memoized so a path that appears in several options is only stat'd once.
+# The cache is cleared in finalize_options, so long-lived processes that
+# run the command repeatedly do not see stale results.
+_cached_isdir = lru_cache(maxsize=None)(os.path.isdir)
+
+def _file_sha256(path):
+    """Returns the SHA-256 digest of a file's contents."""
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(f, 'sha256').digest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+        return digest.digest()
 
 class generate_py_protobufs(Command):
     """Generates Python sources for .proto files."""
@@ -49,9 +83,18 @@ class generate_py_protobufs(Command):
 
         ('protoc=', None,
          'Path to a specific `protoc` command to use.'),
+
+        ('jobs=', None,
+         'Number of protoc invocations to run in parallel, or "auto" '
+         '(the default) to use one per CPU.'),
     ]
     boolean_options = ['recurse']
 
+    # The result of searching $PATH for protoc, shared by all instances in
+    # this process. find_executable stats every $PATH candidate, so it is
+    # only worth doing once.
+    _protoc_cache = None
+
     def initialize_options(self):
         """Sets the defaults for the command options."""
         self.source_dir = None
@@ -61,6 +104,7 @@ class generate_py_protobufs(Command):
         self.proto_files = None
         self.recurse = True
         self.protoc = None
+        self.jobs = 'auto'
 
     def finalize_options(self):
         """Sets the final values for the command options.
@@ -68,13 +112,82 @@ class generate_py_protobufs(Command):
         Defaults were set in `initialize_options`, but could have been changed
         by command-line options or by other commands.
         """
+        _cached_isdir.cache_clear()
         self.ensure_dirname('source_dir')
-        self.ensure_string_list('extra_proto_paths')
+        self.ensure_proto_path_list('extra_proto_paths')
 
         if self.output_dir is None:
             self.output_dir = '.'
         self.ensure_dirname('output_dir')
 
+        if self.proto_root_path is None:
+            self.proto_root_path = self.compute_proto_root_path()
+            if self.proto_root_path != self.source_dir:
+                self.announce('using computed proto_root_path: ' + self.proto_root_path, level=2)
+
+        src = os.path.normpath(self.source_dir)
+        root = os.path.normpath(self.proto_root_path)
+        if not (src == root or src.startswith(root + os.path.sep)):
+            raise DistutilsOptionError('source_dir ' + self.source_dir +
+                                       ' is not under proto_root_path ' + self.proto_root_path)
+
+        if self.proto_files is None:
+            self.proto_files = self.find_proto_files()
+            if not self.proto_files:
+                raise DistutilsOptionError('no .proto files were found under ' + self.source_dir)
+
+        self._ensure_string_list_fast('proto_files')
+
+        if self.protoc is None:
+            self.protoc = os.getenv('PROTOC')
+        if self.protoc is None:
+            if generate_py_protobufs._protoc_cache is None:
+                generate_py_protobufs._protoc_cache = spawn.find_executable('protoc')
+            self.protoc = generate_py_protobufs._protoc_cache
+
+        if self.jobs is None or self.jobs == 'auto':
+            self.jobs = os.cpu_count() or 1
+        else:
+            try:
+                self.jobs = int(self.jobs)
+            except ValueError:
+                raise DistutilsOptionError('jobs must be an integer or "auto"')
+            if self.jobs < 1:
+                raise DistutilsOptionError('jobs must be a positive integer')
+
+        # Build the --proto_path arguments once; run_protoc may be invoked
+        # several times (once per shard when running in parallel), and the
+        # tuple is shared read-only across worker threads.
+        self._proto_path_argv = tuple(
+            ['--proto_path=' + x
+             for x in [self.proto_root_path] + self.extra_proto_paths])
+
+    def _ensure_string_list_fast(self, option):
+        """Like ensure_string_list, but skips revalidating a list of str.
+
+        setup.py callers usually pass options as a list already; distutils's
+        ensure_string_list would still run its regex-based splitter over each
+        element, which is wasted work in that common case.
+        """
+        value = getattr(self, option)
+        if not (isinstance(value, list)
+                and all(isinstance(s, str) for s in value)):
+            self.ensure_string_list(option)
+
+    def ensure_proto_path_list(self, option):
+        """Ensures that 'option' is a list of existing directories."""
+        self._ensure_string_list_fast(option)
+        for path in getattr(self, option):
+            if not _cached_isdir(path):
+                raise DistutilsOptionError(
+                    "'%s' entry is not a directory: %s" % (option, path))
+
+    def compute_proto_root_path(self):
+        """Returns the root for resolving imports in source .proto files.
+
+        This is the shortest prefix of source_dir among [source_dir] +
+        extra_proto_paths, comparing normalized paths.
+        """
         # SUBTLE: if 'source_dir' is a subdirectory of any entry in
         # 'extra_proto_paths', then in general, the shortest --proto_path prefix
         # (and the longest relative .proto filenames) must be used for
@@ -103,45 +216,232 @@ class generate_py_protobufs(Command):
         # different --proto_path arguments, then the path is rejected as an
         # error. (Implementation note: this is enforced in protoc's
         # DiskSourceTree class.)
+        # Local bindings keep the attribute lookups out of the loops below;
+        # extra_proto_paths can be long on heavily vendored trees.
+        normpath = os.path.normpath
+        sep = os.path.sep
+        src = normpath(self.source_dir)
+        # Normalize each candidate exactly once (deduping repeats), and try
+        # them shortest first: the first prefix match is the answer.
+        candidates = sorted(
+            {normpath(p) for p in self.extra_proto_paths}, key=len)
+        for candidate in candidates:
+            # Requiring the separator after the prefix keeps 'a/bc' from
+            # matching the candidate 'a/b'.
+            if src == candidate or src.startswith(candidate + sep):
+                return candidate
+        return src
 
-        if self.proto_root_path is None:
-            self.proto_root_path = os.path.normpath(self.source_dir)
-            for root_candidate in self.extra_proto_paths:
-                root_candidate = os.path.normpath(root_candidate)
-                if self.proto_root_path.startswith(root_candidate):
-                    self.proto_root_path = root_candidate
-            if self.proto_root_path != self.source_dir:
-                self.announce('using computed proto_root_path: ' + self.proto_root_path, level=2)
-
-        if not self.source_dir.startswith(self.proto_root_path):
-            raise DistutilsOptionError('source_dir ' + self.source_dir +
-                                       ' is not under proto_root_path ' + self.proto_root_path)
-
-        if self.proto_files is None:
-            files = glob.glob(os.path.join(self.source_dir, '*.proto'))
-            if self.recurse:
-                files.extend(glob.glob(os.path.join(self.source_dir, '**', '*.proto')))
-            self.proto_files = [f.partition(self.proto_root_path + os.path.sep)[-1] for f in files]
-            if not self.proto_files:
-                raise DistutilsOptionError('no .proto files were found under ' + self.source_dir)
+    def find_proto_files(self):
+        """Finds .proto files under source_dir, relative to proto_root_path.
 
-        self.ensure_string_list('proto_files')
+        Enumeration is a single os.walk/os.scandir pass, which reuses the
+        directory entries' cached type information instead of the extra stat
+        and fnmatch calls that glob would make per entry.
+        """
+        files = []
+        if self.recurse:
+            for dirpath, _, filenames in os.walk(self.source_dir):
+                files.extend(os.path.join(dirpath, name)
+                             for name in filenames if name.endswith('.proto'))
+        else:
+            with os.scandir(self.source_dir) as entries:
+                files.extend(entry.path for entry in entries
+                             if entry.is_file() and entry.name.endswith('.proto'))
 
-        if self.protoc is None:
-            self.protoc = os.getenv('PROTOC')
-        if self.protoc is None:
-            self.protoc = spawn.find_executable('protoc')
+        # The prefix, when present, is always at position 0 (enumeration
+        # started under proto_root_path), so slicing it off beats
+        # str.partition's substring scan and tuple allocation per file.
+        root_prefix = self.proto_root_path + os.path.sep
+        prefix_len = len(root_prefix)
+        return [f[prefix_len:] if f.startswith(root_prefix) else f
+                for f in files]
 
     def run(self):
         # All proto file paths were adjusted in finalize_options to be relative
         # to self.proto_root_path.
-        proto_paths = ['--proto_path=' + self.proto_root_path]
-        proto_paths.extend(['--proto_path=' + x for x in self.extra_proto_paths])
+        dep_cache = self._load_dep_cache()
+        orig_dep_cache = {key: dict(val) for key, val in dep_cache.items()}
+
+        outdated, src_mtimes = self._filter_outdated(self.proto_files, dep_cache)
+        if outdated:
+            saved_proto_files = self.proto_files
+            self.proto_files = outdated
+            snapshot = self._snapshot_outputs(outdated)
+            try:
+                self.run_protoc()
+            finally:
+                self.proto_files = saved_proto_files
+            self._restore_unchanged_mtimes(snapshot)
+
+            # Stamp the source mtimes that were just compiled (as observed
+            # before protoc ran). The next run then treats a byte-identical
+            # output whose timestamp was restored as current, rather than
+            # stale forever.
+            for f in outdated:
+                if f in src_mtimes:
+                    dep_cache['compiled'][f] = src_mtimes[f]
+                else:
+                    dep_cache['compiled'].pop(f, None)
+        else:
+            self.announce('generated sources are up to date', level=2)
+
+        if dep_cache != orig_dep_cache:
+            self._save_dep_cache(dep_cache)
+
+    def _filter_outdated(self, proto_files, dep_cache):
+        """Returns the stale .proto files and their observed source mtimes.
+
+        A file is up to date if the corresponding _pb2.py module exists under
+        output_dir and either its mtime is no older than the source file's,
+        or dep_cache records that this exact source mtime was already
+        compiled (the output keeps its older timestamp when regeneration
+        produced identical bytes). The same must hold for every .proto it
+        (transitively) imports from this set. Anything else (missing or stale
+        output, unreadable source) is recompiled. Import lists are parsed
+        once per source mtime and cached across runs.
+        """
+        compiled = dep_cache['compiled']
+        outdated = set()
+        mtimes = {}
+        for f in proto_files:
+            src = os.path.join(self.proto_root_path, f)
+            dst = self._generated_path(f)
+            try:
+                mtimes[f] = os.stat(src).st_mtime
+                dst_mtime = os.stat(dst).st_mtime
+                if mtimes[f] <= dst_mtime or compiled.get(f) == mtimes[f]:
+                    continue
+            except OSError:
+                pass
+            outdated.add(f)
+
+        # Reverse import graph over the files being generated: rdeps[x] is
+        # the set of files that directly import x. Import statements always
+        # use forward slashes, so the graph is keyed on '/'-separated paths;
+        # proto_files entries use os.sep and are converted at lookup time.
+        rdeps = {}
+        for f in proto_files:
+            for imported in self._proto_imports(f, mtimes.get(f),
+                                                dep_cache['imports']):
+                rdeps.setdefault(imported, set()).add(f)
+
+        # Drop cache entries for files no longer in the set.
+        live = set(proto_files)
+        for key in ('imports', 'compiled'):
+            dep_cache[key] = {f: v for f, v in dep_cache[key].items()
+                              if f in live}
+
+        # A stale file invalidates everything that transitively imports it.
+        queue = [f.replace(os.sep, '/') for f in outdated]
+        while queue:
+            for rdep in rdeps.get(queue.pop(), ()):
+                if rdep not in outdated:
+                    outdated.add(rdep)
+                    queue.append(rdep.replace(os.sep, '/'))
+
+        return [f for f in proto_files if f in outdated], mtimes
+
+    def _generated_path(self, proto_file):
+        """Returns the path of the generated _pb2.py module for a .proto file."""
+        return os.path.join(self.output_dir,
+                            proto_file[:-len('.proto')] + '_pb2.py')
+
+    def _snapshot_outputs(self, proto_files):
+        """Records timestamps and digests of outputs about to be regenerated."""
+        snapshot = {}
+        for f in proto_files:
+            dst = self._generated_path(f)
+            try:
+                st = os.stat(dst)
+                snapshot[dst] = (st.st_atime_ns, st.st_mtime_ns,
+                                 _file_sha256(dst))
+            except OSError:
+                pass
+        return snapshot
+
+    def _restore_unchanged_mtimes(self, snapshot):
+        """Restores timestamps on regenerated outputs with identical bytes.
+
+        Downstream commands (build_py, build_ext, packaging caches) trigger
+        on mtime. When protoc rewrote a file byte-for-byte identically --
+        e.g. the .proto edit only touched comments -- keeping the previous
+        timestamp avoids invalidating their work.
+        """
+        for dst, (atime_ns, mtime_ns, digest) in snapshot.items():
+            try:
+                if _file_sha256(dst) == digest:
+                    os.utime(dst, ns=(atime_ns, mtime_ns))
+            except OSError:
+                pass
+
+    def _proto_imports(self, relpath, mtime, import_cache):
+        """Returns the paths imported by one .proto file, caching by mtime."""
+        entry = import_cache.get(relpath)
+        # Validate the entry's shape as well as its mtime: a cache that is
+        # valid JSON but malformed should degrade to a re-parse, not raise.
+        if (isinstance(entry, list) and len(entry) == 2
+                and entry[0] == mtime and isinstance(entry[1], list)):
+            return entry[1]
+        imports = []
+        try:
+            with open(os.path.join(self.proto_root_path, relpath), 'r') as f:
+                for line in f:
+                    match = _IMPORT_RE.match(line)
+                    if match:
+                        imports.append(match.group(1))
+        except OSError:
+            pass
+        import_cache[relpath] = [mtime, imports]
+        return imports
+
+    def _load_dep_cache(self):
+        """Reads the dependency cache; treats a missing or bad cache as empty."""
+        try:
+            with open(os.path.join(self.output_dir, _DEP_CACHE_NAME), 'r') as f:
+                dep_cache = json.load(f)
+        except (OSError, ValueError):
+            dep_cache = {}
+        if not isinstance(dep_cache, dict):
+            dep_cache = {}
+        return {key: dep_cache[key]
+                if isinstance(dep_cache.get(key), dict) else {}
+                for key in ('imports', 'compiled')}
+
+    def _save_dep_cache(self, dep_cache):
+        """Writes the dependency cache atomically via a temp file and rename."""
+        path = os.path.join(self.output_dir, _DEP_CACHE_NAME)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(dep_cache, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The cache is purely an optimization; never fail the build on it.
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def run_protoc(self):
+        if self.jobs > 1 and len(self.proto_files) >= _PARALLEL_THRESHOLD:
+            # Shard the inputs across one protoc invocation per job. Threads
+            # are sufficient here: each worker blocks in a subprocess, which
+            # does not hold the GIL.
+            chunks = [self.proto_files[i::self.jobs] for i in range(self.jobs)]
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = [executor.submit(self._spawn_protoc, chunk)
+                           for chunk in chunks if chunk]
+            for result in results:
+                result.result()  # Re-raises DistutilsExecError on failure.
+        else:
+            self._spawn_protoc(self.proto_files)
 
+    def _spawn_protoc(self, proto_files):
         # Run protoc. It was already resolved, so don't try to resolve
         # through PATH.
         spawn.spawn(
             [self.protoc,
              '--python_out=' + self.output_dir,
-            ] + proto_paths + self.proto_files,
+            ] + list(self._proto_path_argv) + proto_files,
             search_path=0)